@@ -1,12 +1,26 @@
+import io
+import math
 import subprocess
-from typing import List, Tuple
+import wave
+from typing import List, Optional, Tuple
 
-def _run(cmd: List[str]) -> None:
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if p.returncode != 0:
-        raise RuntimeError(f"Command failed:\n{' '.join(cmd)}\n\nSTDERR:\n{p.stderr}")
+import av
+import mutagen
 
 def probe_duration_seconds(path: str) -> float:
+    """
+    Read the duration from the file header via mutagen (no subprocess).
+    Falls back to ffprobe for anything mutagen can't parse.
+    """
+    try:
+        audio = mutagen.File(path)
+        if audio is not None and audio.info.length > 0:
+            return float(audio.info.length)
+    except Exception:
+        pass
+    return _ffprobe_duration_seconds(path)
+
+def _ffprobe_duration_seconds(path: str) -> float:
     cmd = [
         "ffprobe", "-v", "error",
         "-show_entries", "format=duration",
@@ -24,30 +38,64 @@ def build_chunks(duration: float, chunk_sec: int, overlap_sec: int) -> List[Tupl
     Example: chunk=30, overlap=10 -> step=20 -> 0-30, 20-50, 40-70, ...
     """
     step = max(1, chunk_sec - overlap_sec)
-    out: List[Tuple[float, float]] = []
-    t = 0.0
-    while t < duration:
-        d = min(chunk_sec, max(0.0, duration - t))
-        if d <= 1.0:
-            break
-        out.append((t, d))
-        t += step
-    return out
+    # Starts are computed in closed form (i * step) rather than accumulated.
+    n = math.ceil(duration / step) if duration > 0 else 0
+    out = [(t, min(chunk_sec, duration - t)) for t in (float(i * step) for i in range(n))]
+    return [(t, d) for t, d in out if d > 1.0]
 
-def extract_chunk_wav(src: str, dst: str, start_sec: float, dur_sec: float, sample_rate: int) -> None:
+def pcm_to_wav(pcm: bytes, sample_rate: int) -> bytes:
     """
-    Extract a chunk into mono WAV at given sample rate.
-    Shazam-like recognizers generally do better with a consistent format.
+    Wrap raw mono s16le PCM in a WAV header, in memory.
     """
-    cmd = [
-        "ffmpeg", "-hide_banner", "-loglevel", "error",
-        "-ss", str(start_sec),
-        "-t", str(dur_sec),
-        "-i", src,
-        "-ac", "1",
-        "-ar", str(sample_rate),
-        "-vn",
-        dst,
-        "-y"
-    ]
-    _run(cmd)
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(pcm)
+    return buf.getvalue()
+
+def open_audio(path: str) -> "av.container.InputContainer":
+    """
+    Open the source once for in-process decoding with decode_chunk_pcm.
+    """
+    return av.open(path)
+
+def decode_chunk_pcm(container: "av.container.InputContainer", start_sec: float, dur_sec: float, sample_rate: int) -> bytes:
+    """
+    Decode [start_sec, start_sec + dur_sec) of an already-open PyAV container
+    into mono s16le PCM at sample_rate, without spawning ffmpeg.
+    The container is seeked in place, so callers must not share it across
+    concurrent decodes.
+    """
+    stream = container.streams.audio[0]
+    container.seek(int(start_sec / stream.time_base), stream=stream)
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+
+    end_sec = start_sec + dur_sec
+    first_sec: Optional[float] = None
+    pcm = bytearray()
+
+    def take(frames: List["av.AudioFrame"]) -> None:
+        for out in frames:
+            # Planes may be padded past the last sample; 2 bytes per mono s16 sample.
+            pcm.extend(bytes(out.planes[0])[:out.samples * 2])
+
+    for frame in container.decode(stream):
+        if frame.time is None:
+            continue
+        if frame.time >= end_sec:
+            break
+        if frame.time + frame.samples / frame.sample_rate <= start_sec:
+            continue
+        if first_sec is None:
+            first_sec = frame.time
+        take(resampler.resample(frame))
+    take(resampler.resample(None))
+
+    if first_sec is None:
+        return b""
+    # Decoding starts on a frame boundary; trim to the exact window.
+    skip = max(0, int(round((start_sec - first_sec) * sample_rate)))
+    count = int(round(dur_sec * sample_rate))
+    return bytes(pcm[skip * 2:(skip + count) * 2])
@@ -1,24 +1,36 @@
 import asyncio
+import csv
 import hashlib
 import json
 from dataclasses import dataclass
+from itertools import groupby, islice
+from operator import itemgetter
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Set, Tuple
 from datetime import datetime, timezone
 
+import orjson
 import yaml
 
-from store import Store
-from chunker import probe_duration_seconds, extract_chunk_wav, build_chunks
-from shazam_recognizer import (
-    ShazamIORecognizer,
-    extract_track_id,
-    extract_artist_title,
-    extract_confidence
-)
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
+
+from store import Store, hash_chunk_key
+from chunker import probe_duration_seconds, build_chunks, open_audio, decode_chunk_pcm, pcm_to_wav
+from shazam_recognizer import ShazamIORecognizer, parse_track
 from input_resolver import resolve_audio_input
 import os
 
+# Consecutive matches of one track that put it at computed confidence 1.0.
+SKIP_STREAK = 3
+
+RESULT_FIELDS = [
+    "artist", "title", "shazam_track_id", "confidence", "support",
+    "first_seen_sec", "last_seen_sec", "video_id", "source_audio"
+]
+
 @dataclass
 class TrackAgg:
     shazam_track_id: str
@@ -29,6 +41,34 @@ class TrackAgg:
     first_seen_sec: float
     last_seen_sec: float
 
+# (track_id, artist, title, raw_confidence, start_sec) for one matched chunk
+Hit = Tuple[str, str, str, Optional[float], float]
+
+def aggregate_hits(hits: List[Hit]) -> Dict[str, TrackAgg]:
+    """
+    Fold per-chunk matches into one TrackAgg per track id, in a single pass
+    over the hits sorted by (track_id, start). Artist/title come from the
+    earliest chunk of each track.
+    """
+    tracks: Dict[str, TrackAgg] = {}
+    for tid, group in groupby(sorted(hits, key=itemgetter(0, 4)), key=itemgetter(0)):
+        rows = list(group)
+        support = len(rows)
+        # Computed confidence based on how many chunks matched this track.
+        computed = min(1.0, support / 3.0)  # 1 hit=0.33, 2 hits=0.66, 3+=1.0
+        raw = [float(r[3]) for r in rows if r[3] is not None]
+        _, artist, title, _, first_seen = rows[0]
+        tracks[tid] = TrackAgg(
+            shazam_track_id=tid,
+            artist=artist,
+            title=title,
+            confidence_max=max(raw + [computed]),
+            support=support,
+            first_seen_sec=first_seen,
+            last_seen_sec=rows[-1][4]
+        )
+    return tracks
+
 def load_config(path: str) -> Dict[str, Any]:
     return yaml.safe_load(Path(path).read_text(encoding="utf-8"))
 
@@ -39,9 +79,34 @@ def sha1_of_file(path: str) -> str:
             h.update(chunk)
     return h.hexdigest()
 
+def quick_fingerprint(path: str, sample_bytes: int = 64 * 1024) -> str:
+    """
+    Cheap content fingerprint: file size + BLAKE2b of the first and last 64 KiB.
+    mtime is deliberately left out: a fresh checkout in CI resets it, which would
+    invalidate the committed cache on every run.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        h.update(f.read(sample_bytes))
+        if size > sample_bytes:
+            f.seek(max(sample_bytes, size - sample_bytes))
+            h.update(f.read(sample_bytes))
+    return f"{size}:{h.hexdigest()}"
+
 def utc_run_stamp() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%d_%H-%M-%S")
 
+def write_results_json(path: Path, rows: List[Dict[str, Any]]) -> None:
+    path.write_bytes(orjson.dumps(rows, option=orjson.OPT_INDENT_2))
+
+def write_results_csv(path: Path, rows: List[Dict[str, Any]]) -> None:
+    # Plain csv.writer on prebuilt lists; DictWriter re-resolves every field per row.
+    with path.open("w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(RESULT_FIELDS)
+        w.writerows([[r[k] for k in RESULT_FIELDS] for r in rows])
+
 async def run_pipeline(
     audio_path: str,
     video_id: str,
@@ -51,82 +116,172 @@ async def run_pipeline(
     overlap_seconds: int,
     sample_rate: int,
     max_parallel: int,
-    progress_every: int
+    progress_every: int,
+    full_hash: bool = False,
+    adaptive_skip: int = 0
 ) -> None:
     run_dir.mkdir(parents=True, exist_ok=True)
 
-    work_dir = Path("work")
-    work_dir.mkdir(parents=True, exist_ok=True)
-
-    recognizer = ShazamIORecognizer()
+    recognizer = ShazamIORecognizer(max_connections=max_parallel)
     duration = probe_duration_seconds(audio_path)
     chunks = build_chunks(duration, chunk_seconds, overlap_seconds)
 
-    src_hash = sha1_of_file(audio_path)
+    src_hash = sha1_of_file(audio_path) if full_hash else quick_fingerprint(audio_path)
     sem = asyncio.Semaphore(max_parallel)
 
-    tracks: Dict[str, TrackAgg] = {}
+    chunk_keys = [
+        hash_chunk_key(f"{src_hash}:{start:.2f}:{dur:.2f}:{sample_rate}") for start, dur in chunks
+    ]
+    # One bulk lookup up front; fully cached reruns never decode audio or reach Shazam.
+    # Cached "no match" chunks are present with a None value and are skipped too.
+    cached = store.get_many(chunk_keys)
+
+    # Decoded in-process from one open container; the lock serializes seeks on it.
+    container = open_audio(audio_path)
+    decode_lock = asyncio.Lock()
+
+    hits: List[Hit] = []
+    pending_writes: List[Tuple[int, Optional[Dict[str, Any]]]] = []
+
+    # Adaptive skipping: chunk idx -> matched track id (None = no match) once finished.
+    outcome: Dict[int, Optional[str]] = {}
+    skipped: Set[int] = set()
+    done = [asyncio.Event() for _ in chunks]
+
+    def streak_window(idx: int) -> range:
+        # Enough predecessors to hold SKIP_STREAK unskipped ones between skip runs.
+        return range(max(0, idx - SKIP_STREAK * (adaptive_skip + 1)), idx)
+
+    def looks_confirmed(idx: int) -> bool:
+        """
+        True if every finished chunk in idx's window so far matched one track,
+        i.e. idx may be skippable once the rest of the window finishes.
+        """
+        known = {outcome[i] for i in streak_window(idx) if i in outcome}
+        return len(known) == 1 and None not in known
+
+    def should_skip(idx: int) -> bool:
+        """
+        Skip an uncached chunk when the SKIP_STREAK chunks right before it
+        (ignoring skipped ones) all matched the same track (it is already at
+        confidence 1.0), unless `adaptive_skip` chunks right before it were
+        skipped already. Only called once the whole streak window has finished.
+        """
+        run = 0
+        while idx - 1 - run in skipped:
+            run += 1
+        if run >= adaptive_skip:
+            return False
+        prev = list(islice((i for i in reversed(streak_window(idx)) if i not in skipped), SKIP_STREAK))
+        if len(prev) < SKIP_STREAK:
+            return False
+        recent = {outcome[i] for i in prev}
+        return len(recent) == 1 and None not in recent
+
+    async def decode(start: float, dur: float) -> bytes:
+        async with decode_lock:
+            fut = asyncio.ensure_future(
+                asyncio.to_thread(decode_chunk_pcm, container, start, dur, sample_rate)
+            )
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # The worker thread can't be interrupted; let it finish before
+                # giving up the lock so the container is never closed under it.
+                await asyncio.wait([fut])
+                raise
 
     async def process_one(idx: int, start: float, dur: float) -> None:
-        chunk_key = f"{src_hash}:{start:.2f}:{dur:.2f}:{sample_rate}"
-
-        resp = store.get_chunk(chunk_key)
-        if resp is None:
-            wav_path = str(work_dir / f"chunk_{idx}_{int(start)}.wav")
-            extract_chunk_wav(audio_path, wav_path, start, dur, sample_rate)
+        try:
+            await run_chunk(idx, start, dur)
+        finally:
+            done[idx].set()
 
-            async with sem:
-                resp = await recognizer.recognize_file(wav_path)
+    async def run_chunk(idx: int, start: float, dur: float) -> None:
+        chunk_key = chunk_keys[idx]
 
-            store.put_chunk(chunk_key, resp)
-
-        if not resp:
-            return
-
-        tid = extract_track_id(resp)
-        artist, title = extract_artist_title(resp)
+        if chunk_key in cached:
+            resp = cached[chunk_key]
+        else:
+            # The semaphore bounds extraction + recognition together.
+            await sem.acquire()
+            held = True
+            try:
+                # Checked once the chunk gets a slot, so it sees the latest results.
+                if adaptive_skip > 0 and looks_confirmed(idx):
+                    # Inside a confirmed track: hand the slot back and let the rest
+                    # of the window finish, so the decision depends on the data and
+                    # not on which worker happened to finish first.
+                    sem.release()
+                    held = False
+                    await asyncio.gather(*(done[i].wait() for i in streak_window(idx)))
+                    if should_skip(idx):
+                        # Skipped chunks are not cached.
+                        skipped.add(idx)
+                        return
+                    await sem.acquire()
+                    held = True
+                # Decoding runs in a worker thread so other chunks' Shazam requests
+                # proceed meanwhile; the audio never leaves memory.
+                pcm = await decode(start, dur)
+                wav_bytes = pcm_to_wav(pcm, sample_rate)
+                try:
+                    resp = await recognizer.recognize_bytes(wav_bytes)
+                except Exception as e:
+                    # Not cached, so the next run retries this chunk.
+                    print(f"[warn] recognition failed at {start:.0f}s: {e}")
+                    outcome[idx] = None
+                    return
+            finally:
+                if held:
+                    sem.release()
+
+            pending_writes.append((chunk_key, resp))
+
+        tid, artist, title, raw_conf = parse_track(resp)
         if not tid or not artist or not title:
+            outcome[idx] = None
             return
 
-        raw_conf = extract_confidence(resp)
-
-        agg = tracks.get(tid)
-        if not agg:
-            base = float(raw_conf) if raw_conf is not None else 0.0
-            tracks[tid] = TrackAgg(
-                shazam_track_id=tid,
-                artist=artist,
-                title=title,
-                confidence_max=base,
-                support=1,
-                first_seen_sec=start,
-                last_seen_sec=start
-            )
-        else:
-            agg.support += 1
-            agg.first_seen_sec = min(agg.first_seen_sec, start)
-            agg.last_seen_sec = max(agg.last_seen_sec, start)
-            if raw_conf is not None:
-                agg.confidence_max = max(agg.confidence_max, float(raw_conf))
-
-        # Computed confidence based on how many chunks matched this track.
-        agg2 = tracks[tid]
-        computed = min(1.0, agg2.support / 3.0)  # 1 hit=0.33, 2 hits=0.66, 3+=1.0
-        agg2.confidence_max = max(agg2.confidence_max, computed)
+        outcome[idx] = tid
+        hits.append((tid, artist, title, raw_conf, start))
 
     total = len(chunks)
     processed = 0
 
-    # Simple progress output suitable for GitHub Actions logs
-    for idx, (start, dur) in enumerate(chunks):
-        await process_one(idx, start, dur)
-        processed += 1
-
-        if progress_every <= 1:
-            print(f"[progress] {processed}/{total}")
-        else:
-            if processed % progress_every == 0 or processed == total:
+    def flush_writes() -> None:
+        store.put_chunks_many(pending_writes)
+        pending_writes.clear()
+
+    # All chunks are scheduled at once (the semaphore caps concurrency) and
+    # progress advances as each one finishes, in whatever order that is.
+    # Simple progress output suitable for GitHub Actions logs.
+    # Cache writes are flushed in one transaction per progress tick.
+    tasks = [asyncio.create_task(process_one(idx, start, dur)) for idx, (start, dur) in enumerate(chunks)]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            await fut
+            processed += 1
+
+            if progress_every <= 1:
+                flush_writes()
                 print(f"[progress] {processed}/{total}")
+            else:
+                if processed % progress_every == 0 or processed == total:
+                    flush_writes()
+                    print(f"[progress] {processed}/{total}")
+    finally:
+        # If a chunk failed, stop the rest before flushing and closing what they use.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        flush_writes()
+        await recognizer.close()
+        container.close()
+
+    tracks = aggregate_hits(hits)
+    if skipped:
+        print(f"[info] adaptive skip: {len(skipped)}/{total} chunks not sent to Shazam")
 
     rows: List[Dict[str, Any]] = []
     for tid, agg in sorted(tracks.items(), key=lambda kv: (-kv[1].confidence_max, -kv[1].support)):
@@ -142,21 +297,13 @@ async def run_pipeline(
             "source_audio": Path(audio_path).name
         })
 
-    (run_dir / "results.json").write_text(json.dumps(rows, indent=2, ensure_ascii=False), encoding="utf-8")
-
-    import csv
-    csv_fields = list(rows[0].keys()) if rows else [
-        "artist", "title", "shazam_track_id", "confidence", "support",
-        "first_seen_sec", "last_seen_sec", "video_id", "source_audio"
-    ]
-    with (run_dir / "results.csv").open("w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=csv_fields)
-        w.writeheader()
-        w.writerows(rows)
+    await asyncio.gather(
+        asyncio.to_thread(write_results_json, run_dir / "results.json", rows),
+        asyncio.to_thread(write_results_csv, run_dir / "results.csv", rows)
+    )
 
     # Snapshot SQLite cache into run folder
-    cache_sqlite = Path(store.path)
-    (run_dir / "cache.sqlite").write_bytes(cache_sqlite.read_bytes())
+    store.snapshot_to(str(run_dir / "cache.sqlite"))
 
     meta = {
         "video_id": video_id,
@@ -166,6 +313,8 @@ async def run_pipeline(
         "overlap_seconds": overlap_seconds,
         "sample_rate": sample_rate,
         "max_parallel_chunks": max_parallel,
+        "adaptive_skip": adaptive_skip,
+        "skipped_chunks": len(skipped),
         "distinct_tracks": len(tracks),
         "created_utc": datetime.now(timezone.utc).isoformat()
     }
@@ -189,17 +338,24 @@ def main() -> None:
     store = Store(cfg["cache"]["sqlite_path"])
     run_dir = Path(cfg["output"]["base_dir"]) / utc_run_stamp()
 
-    asyncio.run(run_pipeline(
-        audio_path=audio_path,
-        video_id=video_id,
-        store=store,
-        run_dir=run_dir,
-        chunk_seconds=int(cfg["audio"]["chunk_seconds"]),
-        overlap_seconds=int(cfg["audio"]["overlap_seconds"]),
-        sample_rate=int(cfg["audio"]["sample_rate"]),
-        max_parallel=int(cfg["pipeline"]["max_parallel_chunks"]),
-        progress_every=int(cfg["pipeline"].get("progress_every", 5))
-    ))
+    # uvloop's event loop has much lower per-callback overhead for the Shazam fan-out.
+    run = uvloop.run if uvloop is not None else asyncio.run
+    try:
+        run(run_pipeline(
+            audio_path=audio_path,
+            video_id=video_id,
+            store=store,
+            run_dir=run_dir,
+            chunk_seconds=int(cfg["audio"]["chunk_seconds"]),
+            overlap_seconds=int(cfg["audio"]["overlap_seconds"]),
+            sample_rate=int(cfg["audio"]["sample_rate"]),
+            max_parallel=int(cfg["pipeline"]["max_parallel_chunks"]),
+            progress_every=int(cfg["pipeline"].get("progress_every", 5)),
+            full_hash=bool(cfg["cache"].get("full_hash", False)),
+            adaptive_skip=int(cfg["pipeline"].get("adaptive_skip", 0))
+        ))
+    finally:
+        store.close()
 
     print(f"[done] Run completed: {run_dir}")
 
@@ -1,65 +1,114 @@
-from typing import Optional, Dict, Any
-from shazamio import Shazam
+from typing import Optional, Dict, Any, Tuple, List, Union
 
-def extract_track_id(resp: Dict[str, Any]) -> Optional[str]:
+import aiohttp
+from aiohttp_retry import ExponentialRetry, RetryClient
+from shazamio import Shazam, HTTPClient
+from shazamio.exceptions import BadMethod
+from shazamio.utils import validate_json
+
+def _normalize_confidence(v: Any) -> Optional[float]:
     """
-    Reverse-engineered Shazam responses commonly include a stable per-track key.
-    Field names are not guaranteed, so we try a few candidates.
+    If it's 0..100, we normalize to 0..1.
     """
-    track = resp.get("track") if isinstance(resp, dict) else None
-    if not track:
+    if not isinstance(v, (int, float)):
         return None
+    if 1.0 < v <= 100.0:
+        return float(v) / 100.0
+    return float(v)
 
-    for k in ["key", "id", "shazam_id", "shazamID"]:
-        v = track.get(k)
-        if v:
-            return str(v)
-    return None
-
-def extract_artist_title(resp: Dict[str, Any]) -> tuple[Optional[str], Optional[str]]:
+def parse_track(resp: Dict[str, Any]) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[float]]:
     """
-    Typical Shazam response uses:
-    - title: track title
-    - subtitle: artist
+    Single pass over a Shazam response -> (track_id, artist, title, confidence).
+
+    shazamio responses carry track.key / track.title / track.subtitle (artist),
+    so those are read directly; the other candidate field names seen in
+    reverse-engineered outputs are only tried when they are missing.
+    Confidence is not guaranteed to be present; None if absent.
     """
     track = resp.get("track") if isinstance(resp, dict) else None
     if not track:
-        return None, None
+        return None, None, None, None
 
-    title = track.get("title")
+    tid = track.get("key")
+    if not tid:
+        tid = track.get("id") or track.get("shazam_id") or track.get("shazamID")
     artist = track.get("subtitle") or track.get("artist")
-    return artist, title
+    title = track.get("title")
+
+    conf = _normalize_confidence(track.get("confidence"))
+    if conf is None:
+        conf = _normalize_confidence(track.get("score"))
+    if conf is None:
+        conf = _normalize_confidence(track.get("probability"))
 
-def extract_confidence(resp: Dict[str, Any]) -> Optional[float]:
+    return (str(tid) if tid else None), artist, title, conf
+
+class KeepAliveHTTPClient(HTTPClient):
     """
-    ShazamIO / reverse-engineered outputs do not guarantee a confidence score.
-    If present, we return it as a float.
-    If it's 0..100, we normalize to 0..1.
+    shazamio's HTTPClient opens a new aiohttp session (and TLS connection) per
+    request. This one keeps a single pooled session alive for the whole run.
     """
-    track = resp.get("track") if isinstance(resp, dict) else None
-    if not track:
-        return None
+    def __init__(self, max_connections: int) -> None:
+        # Same retry policy shazamio uses for its default client.
+        super().__init__(retry_options=ExponentialRetry(
+            attempts=20,
+            max_timeout=60,
+            statuses={500, 502, 503, 504, 429},
+        ))
+        self._max_connections = max_connections
+        self._client: Optional[RetryClient] = None
+
+    def _get_client(self) -> RetryClient:
+        # Created lazily: aiohttp sessions must be built inside the running loop.
+        if self._client is None:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._max_connections,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=60
+                ),
+                trace_configs=[self.trace_config]
+            )
+            self._client = RetryClient(
+                client_session=session,
+                retry_options=self.retry_options,
+                raise_for_status=False
+            )
+        return self._client
 
-    for k in ["confidence", "score", "probability"]:
-        v = track.get(k)
-        if isinstance(v, (int, float)):
-            if 1.0 < v <= 100.0:
-                return float(v) / 100.0
-            return float(v)
-    return None
+    async def request(self, method: str, url: str, *args, **kwargs) -> Union[List[Any], Dict[str, Any]]:
+        client = self._get_client()
+        if method.upper() == "GET":
+            async with client.get(url, **kwargs) as resp:
+                return await validate_json(resp, *args)
+        if method.upper() == "POST":
+            async with client.post(url, **kwargs) as resp:
+                return await validate_json(resp, *args)
+        raise BadMethod("Accept only GET/POST")
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
 
 class ShazamIORecognizer:
-    def __init__(self) -> None:
-        self._shazam = Shazam()
+    def __init__(self, max_connections: int = 10) -> None:
+        self._http = KeepAliveHTTPClient(max_connections)
+        self._shazam = Shazam(http_client=self._http)
+
+    async def close(self) -> None:
+        await self._http.close()
 
-    async def recognize_file(self, wav_path: str) -> Optional[Dict[str, Any]]:
+    async def recognize_bytes(self, data: bytes) -> Optional[Dict[str, Any]]:
         """
-        Returns raw response dict if a track match exists; otherwise None.
+        Recognize an in-memory audio file (e.g. WAV bytes).
+        None means Shazam answered with no match (a reply with "matches" but no
+        "track"). Anything else, e.g. an empty body left after shazamio's retries
+        give up on 429/5xx, is raised so callers don't cache a failure as a miss.
         """
-        try:
-            resp = await self._shazam.recognize(wav_path)
-            if not resp or not isinstance(resp, dict) or "track" not in resp:
-                return None
+        resp = await self._shazam.recognize(data)
+        if isinstance(resp, dict) and "track" in resp:
             return resp
-        except Exception:
+        if isinstance(resp, dict) and "matches" in resp:
             return None
+        raise RuntimeError(f"Unexpected Shazam response: {str(resp)[:200]}")
@@ -1,41 +1,161 @@
 import sqlite3
-import json
+import hashlib
 import time
-from typing import Optional, Any, Dict
+from collections import OrderedDict
+from typing import Optional, Any, Dict, List, Tuple
+
+import orjson
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS chunk_cache (
-  chunk_key TEXT PRIMARY KEY,
+  chunk_key INTEGER PRIMARY KEY,
   created_utc INTEGER NOT NULL,
-  shazam_json TEXT
+  shazam_json BLOB
 );
 """
 
+PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+"""
+
+def hash_chunk_key(text_key: str) -> int:
+    """
+    64-bit signed hash of a textual chunk key, stored as the rowid.
+    """
+    digest = hashlib.blake2b(text_key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
 class Store:
     """
     Simple SQLite cache:
-    - chunk_key -> raw Shazam response JSON (or NULL if no match)
+    - chunk_key (hash_chunk_key of the textual key) -> raw Shazam response JSON (or NULL if no match)
+
+    One connection is held for the lifetime of the Store (autocommit, WAL).
+    Call close() when done so the WAL is folded back into the main file.
+    Rows already read or written are kept in a small LRU memo, so repeated
+    lookups of the same key skip SQLite.
     """
-    def __init__(self, path: str):
+    def __init__(self, path: str, memo_size: int = 4096):
         self.path = path
+        self._con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._memo: "OrderedDict[int, Optional[Dict[str, Any]]]" = OrderedDict()
+        self._memo_size = memo_size
         self._init()
 
+    def _remember(self, chunk_key: int, shazam_obj: Optional[Dict[str, Any]]) -> None:
+        self._memo[chunk_key] = shazam_obj
+        self._memo.move_to_end(chunk_key)
+        if len(self._memo) > self._memo_size:
+            self._memo.popitem(last=False)
+
     def _init(self) -> None:
-        with sqlite3.connect(self.path) as con:
-            con.executescript(SCHEMA)
-
-    def get_chunk(self, chunk_key: str) -> Optional[Dict[str, Any]]:
-        with sqlite3.connect(self.path) as con:
-            cur = con.execute("SELECT shazam_json FROM chunk_cache WHERE chunk_key=?", (chunk_key,))
-            row = cur.fetchone()
-            if not row or not row[0]:
-                return None
-            return json.loads(row[0])
-
-    def put_chunk(self, chunk_key: str, shazam_obj: Optional[Dict[str, Any]]) -> None:
-        with sqlite3.connect(self.path) as con:
-            con.execute(
+        self._con.executescript(PRAGMAS)
+        cols = {row[1]: row[2] for row in self._con.execute("PRAGMA table_info(chunk_cache)")}
+        if cols.get("chunk_key", "").upper() == "TEXT":
+            self._migrate_text_keys()
+        self._con.executescript(SCHEMA)
+
+    def _migrate_text_keys(self) -> None:
+        """
+        Older caches used the textual chunk key as PK; rehash them in place.
+        Their NULL rows are dropped: that version also cached request failures
+        as NULL, so they can't be trusted as "no match" and get retried once.
+        """
+        self._con.execute("BEGIN")
+        try:
+            self._con.execute("ALTER TABLE chunk_cache RENAME TO chunk_cache_text")
+            self._con.execute(SCHEMA)
+            rows = self._con.execute(
+                "SELECT chunk_key, created_utc, shazam_json FROM chunk_cache_text WHERE shazam_json IS NOT NULL"
+            ).fetchall()
+            self._con.executemany(
+                "INSERT OR REPLACE INTO chunk_cache (chunk_key, created_utc, shazam_json) VALUES (?, ?, ?)",
+                [(hash_chunk_key(k), created, payload) for k, created, payload in rows]
+            )
+            self._con.execute("DROP TABLE chunk_cache_text")
+        except Exception:
+            self._con.execute("ROLLBACK")
+            raise
+        self._con.execute("COMMIT")
+
+    def close(self) -> None:
+        self._con.close()
+
+    def snapshot_to(self, dst_path: str) -> None:
+        """
+        Copy the live database (including WAL contents) to dst_path using
+        SQLite's online backup API, a few pages at a time. The copy is
+        switched out of WAL so it stays a single self-contained file.
+        """
+        dst = sqlite3.connect(dst_path)
+        try:
+            self._con.backup(dst, pages=1000)
+            dst.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            dst.close()
+
+    def get_chunk(self, chunk_key: int) -> Optional[Dict[str, Any]]:
+        if chunk_key in self._memo:
+            self._memo.move_to_end(chunk_key)
+            return self._memo[chunk_key]
+        cur = self._con.execute("SELECT shazam_json FROM chunk_cache WHERE chunk_key=?", (chunk_key,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        shazam_obj = orjson.loads(row[0]) if row[0] else None
+        self._remember(chunk_key, shazam_obj)
+        return shazam_obj
+
+    def get_many(self, chunk_keys: List[int]) -> Dict[int, Optional[Dict[str, Any]]]:
+        """
+        Bulk version of get_chunk: chunk_key -> response for every cached key.
+        Cached "no match" rows are included with a None value, so
+        `key in result` tells a known miss apart from a key never seen.
+        Keys are queried in groups to stay under SQLite's bound-parameter limit.
+        """
+        out: Dict[int, Optional[Dict[str, Any]]] = {}
+        missing: List[int] = []
+        for chunk_key in chunk_keys:
+            if chunk_key in self._memo:
+                out[chunk_key] = self._memo[chunk_key]
+            else:
+                missing.append(chunk_key)
+
+        for i in range(0, len(missing), 500):
+            group = missing[i:i + 500]
+            placeholders = ",".join("?" * len(group))
+            cur = self._con.execute(
+                f"SELECT chunk_key, shazam_json FROM chunk_cache WHERE chunk_key IN ({placeholders})",
+                group
+            )
+            for chunk_key, shazam_json in cur:
+                shazam_obj = orjson.loads(shazam_json) if shazam_json else None
+                out[chunk_key] = shazam_obj
+                self._remember(chunk_key, shazam_obj)
+        return out
+
+    def put_chunk(self, chunk_key: int, shazam_obj: Optional[Dict[str, Any]]) -> None:
+        self.put_chunks_many([(chunk_key, shazam_obj)])
+
+    def put_chunks_many(self, rows: List[Tuple[int, Optional[Dict[str, Any]]]]) -> None:
+        """
+        Write many (chunk_key, shazam_obj) pairs in a single transaction.
+        """
+        if not rows:
+            return
+        now = int(time.time())
+        self._con.execute("BEGIN")
+        try:
+            self._con.executemany(
                 "INSERT OR REPLACE INTO chunk_cache (chunk_key, created_utc, shazam_json) VALUES (?, ?, ?)",
-                (chunk_key, int(time.time()), json.dumps(shazam_obj) if shazam_obj else None)
+                [(k, now, orjson.dumps(obj) if obj else None) for k, obj in rows]
             )
-            con.commit()
+        except Exception:
+            self._con.execute("ROLLBACK")
+            raise
+        self._con.execute("COMMIT")
+        for k, obj in rows:
+            self._remember(k, obj if obj else None)